@@ -1,10 +1,16 @@
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
-import asyncio, os, aiofiles, json
+import asyncio, os, aiofiles, aiohttp, json, time, signal, hashlib
 from mutagen import File as MutagenFile
-import ffmpeg
 from datetime import timedelta
+from dataclasses import dataclass
+from collections import deque
+from itertools import islice
+try:
+    import orjson  # sérialisation JSON en C, optionnelle
+except ImportError:
+    orjson = None
 
 # ─── CONFIG ────────────────────────────────────────────────────────────────
 from dotenv import load_dotenv
@@ -15,6 +21,9 @@ TOKEN = os.getenv("TOKEN")
 AUDIO_DIR = "audio"
 PLAYLISTS_DIR = "playlists"
 DATA_DIR = "data"
+AUDIO_EXTS = frozenset({".mp3", ".wav", ".ogg", ".m4a"})
+# ffmpeg sans stdin ni bannière, pistes vidéo/sous-titres/données ignorées ; -loglevel passe après celui de discord.py
+FFMPEG_OPTIONS = {"before_options": "-nostdin -hide_banner", "options": "-vn -sn -dn -loglevel error"}
 
 # ─── CRÉER LES DOSSIERS SI MANQUANT ────────────────────────────────────────
 for folder in [AUDIO_DIR, PLAYLISTS_DIR, DATA_DIR]:
@@ -27,23 +36,54 @@ bot = commands.Bot(command_prefix="!", intents=intents)
 tree = bot.tree
 
 # ─── VARIABLES MULTI-SERVEUR ──────────────────────────────────────────────
-queues = {}        # queues[guild_id] = [nom_audio,...]
-current_audio = {} # current_audio[guild_id] = fichier en cours
-current_start = {} # current_start[guild_id] = timestamp
+@dataclass(slots=True)
+class NowPlaying:
+    name: str          # fichier en cours
+    start_time: float  # timestamp du début de lecture
+    duration: float    # durée du fichier en secondes
+
+queues = {}        # queues[guild_id] = deque([nom_audio,...])
+now_playing = {}   # now_playing[guild_id] = NowPlaying ou None
+queue_durations = {} # queue_durations[guild_id] = durée totale de la file, tenue à jour à chaque ajout / retrait
+queued_durations = {} # queued_durations[guild_id] = {nom_audio: durée comptée à l'ajout}
 voice_clients = {} # voice_clients[guild_id] = VoiceClient
 is_playing = {}    # is_playing[guild_id] = bool
 
+# ─── CACHE DES DURÉES ─────────────────────────────────────────────────────
+DURATION_CACHE_PATH = os.path.join(DATA_DIR, "durations.json")
+DURATION_FLUSH_DELAY = 30
+_duration_cache = {} # _duration_cache[chemin] = (mtime_ns, taille, durée)
+_duration_flush = {"dirty": False, "handle": None, "future": None}
+
 # ─── UTILITAIRES ──────────────────────────────────────────────────────────
-def save_json(path: str, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+_saved_hashes = {} # _saved_hashes[chemin] = hash du dernier contenu écrit
+
+def dump_json(data, indent=True) -> bytes:
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else None)
+    if indent:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def save_json(path: str, data, indent=True):
+    raw = dump_json(data, indent)
+    h = hash(raw)
+    if _saved_hashes.get(path) == h:
+        return  # contenu identique au dernier écrit, rien à faire
+    # Écriture dans un fichier temporaire puis renommage atomique : pas de JSON tronqué en cas de crash
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(raw)
+    os.replace(tmp, path)
+    _saved_hashes[path] = h
     print(f"💾 JSON sauvegardé : {path}")
 
 def load_json(path: str):
     if not os.path.exists(path):
         return {}
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(path, "rb") as f:
+        raw = f.read()
+    return orjson.loads(raw) if orjson else json.loads(raw)
 
 def get_queue_path(guild_id):
     return os.path.join(DATA_DIR, f"queue_{guild_id}.json")
@@ -51,56 +91,325 @@ def get_queue_path(guild_id):
 def get_playlist_path(guild_id):
     return os.path.join(PLAYLISTS_DIR, f"{guild_id}.json")
 
+# Les durées de moins d'une heure sont pré-formatées une fois pour toutes
+_HUMAN_TIME_TABLE = [str(timedelta(seconds=s)) for s in range(3600)]
+
 def human_time(seconds):
-    return str(timedelta(seconds=int(seconds)))
+    s = int(seconds)
+    if 0 <= s < 3600:
+        return _HUMAN_TIME_TABLE[s]
+    return str(timedelta(seconds=s))
 
-def get_audio_duration(path):
+def _mutagen_duration(path):
     try:
         m = MutagenFile(path)
         if m and m.info:
             return m.info.length
     except:
         pass
+    return None
+
+def _store_duration(key, dur):
+    # Une seule entrée par chemin : un fichier réécrit remplace son ancienne durée au lieu de s'y ajouter
+    path, mtime, size = key
+    _duration_cache[path] = (mtime, size, dur)
+    _duration_flush["dirty"] = True
+
+def _cached_duration(path):
+    # Durée mise en cache par (chemin, mtime, taille) : un fichier modifié est re-analysé.
+    # Renvoie (clé, durée) ; clé à None si le fichier n'existe pas, durée à None si elle n'est pas en cache.
     try:
-        probe = ffmpeg.probe(path)
-        return float(probe['format']['duration'])
-    except:
+        st = os.stat(path)
+    except OSError:
+        return None, 0
+    key = (path, st.st_mtime_ns, st.st_size)
+    entry = _duration_cache.get(path)
+    if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+        return key, entry[2]
+    return key, None
+
+async def _ffprobe_duration(path):
+    # ffprobe piloté par la boucle : aucun thread n'est bloqué pendant le sous-processus
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "quiet", "-threads", "1", "-show_entries", "format=duration", "-of", "csv=p=0", "-i", path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        out, _ = await proc.communicate()
+        return float(out.strip())
+    except (OSError, ValueError):
         return 0
 
-def progress_bar(current, total, size=20):
+# Limite le nombre d'analyses simultanées (et donc de ffprobe lancés en parallèle)
+DURATION_PROBE_CONCURRENCY = min(8, os.cpu_count() or 4)
+_duration_sem = asyncio.Semaphore(DURATION_PROBE_CONCURRENCY)
+
+async def get_audio_duration(path):
+    key, dur = await asyncio.to_thread(_cached_duration, path)
+    if dur is None:
+        # Seules les vraies analyses passent par le sémaphore : un fichier en cache ne fait jamais la queue
+        async with _duration_sem:
+            dur = await asyncio.to_thread(_mutagen_duration, path)
+            if dur is None:
+                dur = await _ffprobe_duration(path)
+        _store_duration(key, dur)
+        schedule_duration_flush()
+    return dur
+
+async def get_durations(names):
+    return await asyncio.gather(*(get_audio_duration(os.path.join(AUDIO_DIR, n)) for n in names))
+
+# Analyses d'arrière-plan simultanées : le reste du sémaphore reste libre pour les commandes
+BACKGROUND_PROBE_BATCH = max(1, DURATION_PROBE_CONCURRENCY // 4)
+
+async def get_durations_background(names):
+    # Par petits lots : une commande attend au plus un lot, jamais toute la bibliothèque
+    durs = []
+    for i in range(0, len(names), BACKGROUND_PROBE_BATCH):
+        durs.extend(await get_durations(names[i:i + BACKGROUND_PROBE_BATCH]))
+    return durs
+
+async def prewarm_durations():
+    # Analyse en arrière-plan au démarrage : le premier /list ou /play n'attend plus les fichiers
+    await get_durations_background(list_audio_files())
+
+def schedule_duration_flush():
+    # Les nouvelles durées sont écrites sur disque au plus une fois par DURATION_FLUSH_DELAY
+    if _duration_flush["dirty"] and _duration_flush["handle"] is None:
+        loop = asyncio.get_running_loop()
+        _duration_flush["handle"] = loop.call_later(DURATION_FLUSH_DELAY, _flush_duration_cache, loop)
+
+def _flush_duration_cache(loop):
+    _duration_flush["handle"] = None
+    pending = _duration_flush["future"]
+    if pending and not pending.done():
+        schedule_duration_flush()  # écriture précédente pas terminée : jamais deux écritures du même fichier
+        return
+    _duration_flush["dirty"] = False
+    fut = loop.run_in_executor(None, save_duration_cache)
+    fut.add_done_callback(_report_duration_save_error)
+    _duration_flush["future"] = fut
+
+def _report_duration_save_error(fut):
+    if not fut.cancelled() and fut.exception():
+        print("Erreur sauvegarde des durées:", fut.exception())
+        _duration_flush["dirty"] = True  # retentée à la prochaine écriture ou à l'arrêt
+
+def take_duration_flush():
+    # Annule l'écriture programmée et indique s'il reste des durées à écrire
+    handle = _duration_flush["handle"]
+    if handle:
+        handle.cancel()
+        _duration_flush["handle"] = None
+    dirty = _duration_flush["dirty"]
+    _duration_flush["dirty"] = False
+    return dirty
+
+def load_duration_cache():
+    # Un cache illisible ou d'un ancien format est ignoré : les durées seront simplement recalculées
+    try:
+        data = load_json(DURATION_CACHE_PATH)
+        for path, mtime, size, dur in data or []:
+            _duration_cache[path] = (mtime, size, dur)
+    except (OSError, ValueError, TypeError) as e:
+        print("Cache des durées ignoré :", e)
+
+def save_duration_cache():
+    entries = [[path, *entry] for path, entry in list(_duration_cache.items())]
+    save_json(DURATION_CACHE_PATH, entries, indent=False)  # lu uniquement par le bot
+
+def is_audio(name):
+    # Seule l'extension est mise en minuscules, pas le nom entier
+    dot = name.rfind(".")
+    return dot >= 0 and name[dot:].lower() in AUDIO_EXTS
+
+_audio_listing = {"mtime": None, "files": []}
+
+def list_audio_files():
+    # Relit le dossier seulement si son mtime a changé (ajout/suppression de fichier)
+    mtime = os.stat(AUDIO_DIR).st_mtime_ns
+    if mtime != _audio_listing["mtime"]:
+        with os.scandir(AUDIO_DIR) as it:
+            _audio_listing["files"] = sorted(
+                e.name for e in it
+                if e.is_file() and is_audio(e.name)
+            )
+        _audio_listing["mtime"] = mtime
+        _prune_duration_cache(_audio_listing["files"])
+    return list(_audio_listing["files"])
+
+def _prune_duration_cache(files):
+    # Oublie les durées des fichiers qui ne sont plus dans le dossier audio
+    present = {os.path.join(AUDIO_DIR, f) for f in files}
+    for path in [p for p in list(_duration_cache) if p not in present]:
+        _duration_cache.pop(path, None)
+        _duration_flush["dirty"] = True
+
+def invalidate_audio_listing():
+    # Le mtime d'un dossier peut avoir une résolution grossière : on force la relecture après un ajout
+    _audio_listing["mtime"] = None
+
+PROGRESS_BAR_SIZE = 20
+_BAR_TABLE = ["▰" * i + "▱" * (PROGRESS_BAR_SIZE - i) for i in range(PROGRESS_BAR_SIZE + 1)]
+
+def progress_bar(current, total, size=PROGRESS_BAR_SIZE):
     filled = int(size * current / total) if total else 0
-    empty = size - filled
-    return "▰" * filled + "▱" * empty
+    filled = max(0, min(filled, size))
+    if size == PROGRESS_BAR_SIZE:
+        return _BAR_TABLE[filled]
+    return "▰" * filled + "▱" * (size - filled)
+
+# ─── SAUVEGARDE DES FILES ─────────────────────────────────────────────────
+# Les modifications de file sont regroupées : une rafale de /play donne une seule écriture
+QUEUE_FLUSH_DELAY = 0.25
+QUEUE_RETRY_DELAY = 5  # attente avant de retenter une écriture échouée (disque plein, droits…)
+_dirty_queues = set()   # serveurs dont la file doit être réécrite
+_flush_event = asyncio.Event()
+_flusher_task = None
+_queue_write_lock = asyncio.Lock()  # une seule écriture de files à la fois : même fichier .tmp
+
+def mark_queue_dirty(guild_id):
+    _dirty_queues.add(guild_id)
+    _flush_event.set()
+
+def _snapshot_dirty_queues():
+    # Copie prise sur la boucle : les deques ne doivent pas être lues depuis un thread
+    snapshot = {guild_id: list(queues.get(guild_id, ())) for guild_id in _dirty_queues}
+    _dirty_queues.clear()
+    return snapshot
+
+def _write_queues(snapshot):
+    for guild_id, queue in snapshot.items():
+        save_json(get_queue_path(guild_id), queue, indent=False)  # lu uniquement par le bot
+
+def flush_queues():
+    _write_queues(_snapshot_dirty_queues())
+
+async def queue_flusher():
+    while not bot.is_closed():
+        await _flush_event.wait()
+        await asyncio.sleep(QUEUE_FLUSH_DELAY)
+        _flush_event.clear()
+        snapshot = _snapshot_dirty_queues()
+        try:
+            async with _queue_write_lock:
+                await asyncio.to_thread(_write_queues, snapshot)
+        except Exception as e:
+            # La tâche ne doit pas s'arrêter : les serveurs non écrits sont remis dans la liste et retentés
+            print("Erreur sauvegarde des files:", e)
+            _dirty_queues.update(snapshot)
+            _flush_event.set()
+            await asyncio.sleep(QUEUE_RETRY_DELAY)
 
 # ─── QUEUE / LECTURE ──────────────────────────────────────────────────────
-async def play_next(guild_id):
-    if guild_id not in queues or not queues[guild_id]:
-        is_playing[guild_id] = False
-        current_audio[guild_id] = None
-        return
+_voice_locks = {}  # _voice_locks[guild_id] = asyncio.Lock
 
-    is_playing[guild_id] = True
-    current_audio[guild_id] = queues[guild_id].pop(0)
-    current_start[guild_id] = asyncio.get_event_loop().time()
-    path = os.path.join(AUDIO_DIR, current_audio[guild_id])
-    vc = voice_clients[guild_id]
+def voice_lock(guild_id):
+    # Sérialise connexion / déconnexion / lecture au sein d'un même serveur
+    return _voice_locks.setdefault(guild_id, asyncio.Lock())
 
-    def after_play(error):
-        fut = asyncio.run_coroutine_threadsafe(play_next(guild_id), bot.loop)
-        try:
-            fut.result()
-        except Exception as e:
-            print("Erreur play_next:", e)
+def _report_play_next_error(fut):
+    if not fut.cancelled() and fut.exception():
+        print("Erreur play_next:", fut.exception())
 
-    vc.play(discord.FFmpegPCMAudio(path), after=after_play)
-    save_json(get_queue_path(guild_id), queues[guild_id])
+async def play_next(guild_id):
+    async with voice_lock(guild_id):
+        vc = voice_clients.get(guild_id)
+        if vc and (vc.is_playing() or vc.is_paused()):
+            return  # un autre appel a déjà lancé la lecture
+
+        queue = queues.get(guild_id)
+        # Boucle plutôt que récursion : les fichiers absents ou illisibles sont sautés un par un
+        while vc and queue:
+            name = queue.popleft()
+            path = os.path.join(AUDIO_DIR, name)
+            # On retire la durée comptée à l'ajout, même si le fichier a disparu entre-temps
+            counted = queued_durations.get(guild_id, {}).get(name, 0.0)
+            queue_durations[guild_id] = max(0.0, queue_durations.get(guild_id, 0.0) - counted)
+            if not os.path.exists(path):
+                print(f"Fichier introuvable, ignoré : {name}")
+                continue
+            try:
+                # Le lancement du sous-processus ffmpeg est bloquant : on le fait hors de la boucle
+                source = await asyncio.to_thread(discord.FFmpegOpusAudio, path, **FFMPEG_OPTIONS)
+                break
+            except Exception as e:
+                print(f"Erreur lecture {name}:", e)
+        else:
+            is_playing[guild_id] = False
+            now_playing[guild_id] = None
+            if not queue:
+                queue_durations[guild_id] = 0.0
+                queued_durations.pop(guild_id, None)
+            if queue is not None:
+                mark_queue_dirty(guild_id)
+            await refresh_presence()
+            return
+
+        is_playing[guild_id] = True
+        np = now_playing[guild_id] = NowPlaying(name, time.monotonic(), 0.0)
+        mark_queue_dirty(guild_id)
+
+        def after_play(error):
+            # Appelé depuis le thread audio : on planifie la suite sans attendre son résultat
+            fut = asyncio.run_coroutine_threadsafe(play_next(guild_id), bot.loop)
+            fut.add_done_callback(_report_play_next_error)
+
+        vc.play(source, after=after_play)
+        await refresh_presence()
+
+    # Durée lue après le lancement et hors du verrou : le changement de morceau n'attend pas l'analyse
+    np.duration = await get_audio_duration(path)
 
 # ─── EVENTS ───────────────────────────────────────────────────────────────
+COMMANDS_HASH_PATH = os.path.join(DATA_DIR, "commands_hash.txt")
+
+async def sync_commands():
+    # La synchro globale est lente et limitée par Discord : on ne la refait que si les commandes ont changé
+    payload = json.dumps([bot.application_id, [c.to_dict(tree) for c in tree.get_commands()]], sort_keys=True)
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    if os.path.exists(COMMANDS_HASH_PATH):
+        with open(COMMANDS_HASH_PATH, "r", encoding="utf-8") as f:
+            if f.read().strip() == digest:
+                return False
+    await tree.sync()  # global pour tous les serveurs
+    with open(COMMANDS_HASH_PATH, "w", encoding="utf-8") as f:
+        f.write(digest)
+    return True
+
+_startup = {"done": False}
+
 @bot.event
 async def on_ready():
-    await tree.sync()  # global pour tous les serveurs
-    print(f"✅ Bot prêt : {bot.user} — {len(tree.get_commands())} commandes sync")
-    bot.loop.create_task(nowplaying_updater())
+    global _flusher_task
+    if _flusher_task is None:
+        _flusher_task = bot.loop.create_task(queue_flusher())
+    # Une nouvelle session Discord remet la présence à zéro : on la renvoie à chaque on_ready
+    _presence["sent"] = False
+    await refresh_presence()
+    if _startup["done"]:
+        return  # simple reconnexion : tout est déjà initialisé
+    await asyncio.to_thread(load_duration_cache)
+    synced = await sync_commands()
+    _startup["done"] = True  # seulement après succès : sinon le prochain on_ready réessaie
+    print(f"✅ Bot prêt : {bot.user} — {len(tree.get_commands())} commandes {'sync' if synced else 'déjà à jour'}")
+    bot.loop.create_task(prewarm_durations())
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    # Le bot a quitté le vocal (/leave, kick, coupure) : on oublie l'état de lecture du serveur
+    if member.id != bot.user.id or not before.channel or after.channel:
+        return
+    guild_id = before.channel.guild.id
+    async with voice_lock(guild_id):
+        voice_clients.pop(guild_id, None)
+        now_playing.pop(guild_id, None)
+        is_playing.pop(guild_id, None)
+        queue_durations.pop(guild_id, None)
+        queued_durations.pop(guild_id, None)
+        if queues.pop(guild_id, None):
+            mark_queue_dirty(guild_id)
+    await refresh_presence()
 
 # ─── COMMANDE /join ───────────────────────────────────────────────────────
 @tree.command(name="join", description="Rejoint ton salon vocal")
@@ -108,8 +417,9 @@ async def join(interaction: discord.Interaction):
     guild_id = interaction.guild.id
     if interaction.user.voice:
         channel = interaction.user.voice.channel
-        vc = await channel.connect()
-        voice_clients[guild_id] = vc
+        async with voice_lock(guild_id):
+            vc = await channel.connect()
+            voice_clients[guild_id] = vc
         await interaction.response.send_message(f"✅ Connecté à {channel.name}", ephemeral=True)
     else:
         await interaction.response.send_message("❌ Tu dois être dans un salon vocal", ephemeral=True)
@@ -118,40 +428,65 @@ async def join(interaction: discord.Interaction):
 @tree.command(name="leave", description="Déconnecte le bot")
 async def leave(interaction: discord.Interaction):
     guild_id = interaction.guild.id
-    vc = voice_clients.get(guild_id)
-    if vc and vc.is_connected():
-        await vc.disconnect()
-        voice_clients[guild_id] = None
+    async with voice_lock(guild_id):
+        vc = voice_clients.get(guild_id)
+        connected = vc and vc.is_connected()
+        if connected:
+            await vc.disconnect()
+            voice_clients[guild_id] = None
+    if connected:
         await interaction.response.send_message("👋 Déconnecté.", ephemeral=True)
     else:
         await interaction.response.send_message("❌ Le bot n'est pas connecté.", ephemeral=True)
 
 # ─── COMMANDE /upload ─────────────────────────────────────────────────────
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 Mio accumulé avant chaque écriture : peu d'allers-retours vers le thread
+
 @tree.command(name="upload", description="Upload un fichier audio")
 async def upload(interaction: discord.Interaction, fichier: discord.Attachment):
-    if not fichier.filename.lower().endswith((".mp3", ".wav", ".ogg", ".m4a")):
+    if not is_audio(fichier.filename):
         await interaction.response.send_message("❌ Format non supporté.", ephemeral=True)
         return
     path = os.path.join(AUDIO_DIR, fichier.filename)
-    async with aiofiles.open(path, "wb") as f:
-        await f.write(await fichier.read())
+    # Téléchargement par morceaux dans un .part, renommé une fois complet : jamais de fichier tronqué dans AUDIO_DIR
+    tmp = path + ".part"
+    try:
+        async with aiohttp.ClientSession() as session, session.get(fichier.url) as resp:
+            resp.raise_for_status()
+            async with aiofiles.open(tmp, "wb") as f:
+                # aiohttp ne livre que ce qui est déjà reçu (bien moins d'1 Mio) : on regroupe avant d'écrire
+                buf = bytearray()
+                async for chunk in resp.content.iter_any():
+                    buf += chunk
+                    if len(buf) >= UPLOAD_CHUNK_SIZE:
+                        await f.write(buf)
+                        buf.clear()
+                if buf:
+                    await f.write(buf)
+        os.replace(tmp, path)
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+        print(f"Erreur upload {fichier.filename}:", e)
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        await interaction.response.send_message("❌ Échec du téléchargement du fichier.", ephemeral=True)
+        return
+    invalidate_audio_listing()
     await interaction.response.send_message(f"✅ Fichier **{fichier.filename}** ajouté.")
 
 # ─── COMMANDE /list ───────────────────────────────────────────────────────
 @tree.command(name="list", description="Liste les fichiers audio avec durée")
 async def list_audio(interaction: discord.Interaction):
-    files = [f for f in os.listdir(AUDIO_DIR) if f.lower().endswith((".mp3", ".wav", ".ogg", ".m4a"))]
+    files = list_audio_files()
     if not files:
         await interaction.response.send_message("🎵 Aucun fichier trouvé.")
         return
-    msg = "**🎶 Fichiers disponibles :**\n"
-    total = 0
-    for f in files:
-        dur = get_audio_duration(os.path.join(AUDIO_DIR, f))
-        total += dur
-        msg += f"• `{f}` — {human_time(dur)}\n"
-    msg += f"\n⏱️ Temps total de toutes les musiques : {human_time(total)}"
-    await interaction.response.send_message(msg)
+    durs = await get_durations(files)
+    parts = ["**🎶 Fichiers disponibles :**\n"]
+    parts.extend(f"• `{f}` — {human_time(dur)}\n" for f, dur in zip(files, durs))
+    parts.append(f"\n⏱️ Temps total de toutes les musiques : {human_time(sum(durs))}")
+    await interaction.response.send_message("".join(parts))
 
 # ─── COMMANDE /play ───────────────────────────────────────────────────────
 @tree.command(name="play", description="Joue un fichier audio local")
@@ -164,33 +499,56 @@ async def play(interaction: discord.Interaction, nom: str):
     if not interaction.user.voice:
         await interaction.response.send_message("❌ Tu dois être dans un salon vocal.")
         return
-    if guild_id not in voice_clients or not voice_clients[guild_id] or not voice_clients[guild_id].is_connected():
-        vc = await interaction.user.voice.channel.connect()
-        voice_clients[guild_id] = vc
+    async with voice_lock(guild_id):
+        vc = voice_clients.get(guild_id)
+        if not vc or not vc.is_connected():
+            voice_clients[guild_id] = await interaction.user.voice.channel.connect()
 
-    queues.setdefault(guild_id, []).append(nom)
-    save_json(get_queue_path(guild_id), queues[guild_id])
+    queues.setdefault(guild_id, deque()).append(nom)
+    mark_queue_dirty(guild_id)
     await interaction.response.send_message(f"🎧 Ajouté à la file : `{nom}`")
     if not is_playing.get(guild_id, False):
         await play_next(guild_id)
+    bot.loop.create_task(_add_queued_duration(guild_id, nom, path))
+
+async def _add_queued_duration(guild_id, nom, path):
+    # Durée analysée après l'ajout : l'ordre de la file et le lancement de la lecture n'attendent jamais l'analyse
+    dur = await get_audio_duration(path)
+    queue = queues.get(guild_id)
+    if not queue or nom not in queue:
+        return  # déjà joué ou file vidée entre-temps : rien à compter
+    queued_durations.setdefault(guild_id, {})[nom] = dur
+    queue_durations[guild_id] = queue_durations.get(guild_id, 0.0) + dur
 
 # ─── COMMANDE /playall ────────────────────────────────────────────────────
 @tree.command(name="playall", description="Joue tous les fichiers audio")
 async def playall(interaction: discord.Interaction):
     guild_id = interaction.guild.id
-    files = [f for f in os.listdir(AUDIO_DIR) if f.lower().endswith((".mp3", ".wav", ".ogg", ".m4a"))]
+    files = list_audio_files()
     if not files:
         await interaction.response.send_message("🎵 Aucun fichier audio trouvé.")
         return
-    queues[guild_id] = files
-    save_json(get_queue_path(guild_id), queues[guild_id])
-    if not voice_clients.get(guild_id) or not voice_clients[guild_id].is_connected():
-        if interaction.user.voice:
-            vc = await interaction.user.voice.channel.connect()
-            voice_clients[guild_id] = vc
+    queues[guild_id] = deque(files)
+    queue_durations[guild_id] = 0.0  # calculée en arrière-plan, voir _fill_queue_duration
+    queued_durations[guild_id] = {}
+    mark_queue_dirty(guild_id)
+    async with voice_lock(guild_id):
+        vc = voice_clients.get(guild_id)
+        if (not vc or not vc.is_connected()) and interaction.user.voice:
+            voice_clients[guild_id] = await interaction.user.voice.channel.connect()
     await interaction.response.send_message(f"🎶 Tous les fichiers ont été ajoutés à la file ({len(files)}).")
     if not is_playing.get(guild_id, False):
         await play_next(guild_id)
+    bot.loop.create_task(_fill_queue_duration(guild_id, files))
+
+async def _fill_queue_duration(guild_id, files):
+    # Les durées sont analysées une fois la lecture lancée : le premier morceau n'attend pas toute la bibliothèque
+    by_name = dict(zip(files, await get_durations_background(files)))
+    queue = queues.get(guild_id)
+    if queue is not None:
+        counted = queued_durations.setdefault(guild_id, {})
+        counted.update(by_name)
+        queue_durations[guild_id] = sum(counted.get(name, 0.0) for name in queue)
 
 # ─── AUTRES COMMANDES ─────────────────────────────────────────────────────
 @tree.command(name="pause", description="Met en pause")
@@ -223,14 +581,48 @@ async def skip(interaction: discord.Interaction):
 @tree.command(name="stop", description="Arrête et vide la queue")
 async def stop(interaction: discord.Interaction):
     guild_id = interaction.guild.id
-    queues[guild_id] = []
-    save_json(get_queue_path(guild_id), queues[guild_id])
-    vc = voice_clients.get(guild_id)
-    if vc and vc.is_playing():
-        vc.stop()
-    is_playing[guild_id] = False
-    current_audio[guild_id] = None
+    async with voice_lock(guild_id):
+        queues[guild_id] = deque()
+        queue_durations[guild_id] = 0.0
+        queued_durations.pop(guild_id, None)
+        mark_queue_dirty(guild_id)
+        vc = voice_clients.get(guild_id)
+        if vc and (vc.is_playing() or vc.is_paused()):
+            vc.stop()  # en pause aussi, sinon play_next croit la lecture toujours en cours
+        is_playing[guild_id] = False
+        now_playing[guild_id] = None
     await interaction.response.send_message("⛔ Lecture arrêtée et queue vidée.")
+    await refresh_presence()
+
+QUEUE_PAGE_SIZE = 20
+
+def render_queue_page(q, page):
+    pages = max(1, -(-len(q) // QUEUE_PAGE_SIZE))
+    start = page * QUEUE_PAGE_SIZE
+    parts = [f"**🎵 File d’attente :** (page {page + 1}/{pages})\n"]
+    parts.extend(f"{i}. {song}\n" for i, song in enumerate(islice(q, start, start + QUEUE_PAGE_SIZE), start + 1))
+    return "".join(parts)
+
+class QueueView(discord.ui.View):
+    # Pagination de /queue : le message ne dépasse jamais la limite de Discord
+    def __init__(self, guild_id):
+        super().__init__(timeout=120)
+        self.guild_id = guild_id
+        self.page = 0
+
+    async def show(self, interaction, delta):
+        q = queues.get(self.guild_id, [])
+        pages = max(1, -(-len(q) // QUEUE_PAGE_SIZE))
+        self.page = (self.page + delta) % pages
+        await interaction.response.edit_message(content=render_queue_page(q, self.page), view=self)
+
+    @discord.ui.button(emoji="⬅️", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, -1)
+
+    @discord.ui.button(emoji="➡️", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, 1)
 
 @tree.command(name="queue", description="Affiche la file d’attente")
 async def show_queue(interaction: discord.Interaction):
@@ -239,48 +631,82 @@ async def show_queue(interaction: discord.Interaction):
     if not q:
         await interaction.response.send_message("🕳️ La file est vide.")
         return
-    msg = "**🎵 File d’attente :**\n"
-    for i, song in enumerate(q, 1):
-        msg += f"{i}. {song}\n"
-    await interaction.response.send_message(msg)
+    if len(q) <= QUEUE_PAGE_SIZE:
+        await interaction.response.send_message(render_queue_page(q, 0))
+    else:
+        await interaction.response.send_message(render_queue_page(q, 0), view=QueueView(guild_id))
 
 # ─── COMMANDE /nowplaying ─────────────────────────────────────────────────
 @tree.command(name="nowplaying", description="Musique en cours")
 async def nowplaying(interaction: discord.Interaction):
     guild_id = interaction.guild.id
-    if not current_audio.get(guild_id):
+    np = now_playing.get(guild_id)
+    if not np:
         await interaction.response.send_message("❌ Aucune musique en cours.")
         return
 
-    dur = get_audio_duration(os.path.join(AUDIO_DIR, current_audio[guild_id]))
-    elapsed = asyncio.get_event_loop().time() - current_start[guild_id]
-    remaining = elapsed
-    total_remaining = dur
-    for song in queues.get(guild_id, []):
-        total_remaining += get_audio_duration(os.path.join(AUDIO_DIR, song))
+    dur = np.duration
+    elapsed = time.monotonic() - np.start_time
+    total_remaining = dur + queue_durations.get(guild_id, 0.0)
 
     bar = progress_bar(elapsed, dur)
     embed = discord.Embed(
-        title=f"🎶 Lecture en cours : {current_audio[guild_id]}",
+        title=f"🎶 Lecture en cours : {np.name}",
         description=f"{bar}\n`{human_time(elapsed)} / {human_time(dur)}`\n⏱️ Temps total restant : {human_time(total_remaining)}",
         color=0x1DB954,
     )
     await interaction.response.send_message(embed=embed)
 
-# ─── TÂCHE / NOWPLAYING UPDATER ───────────────────────────────────────────
-async def nowplaying_updater():
-    await bot.wait_until_ready()
-    while not bot.is_closed():
-        await asyncio.sleep(2)
-        for guild_id, vc in voice_clients.items():
-            if current_audio.get(guild_id) and vc and vc.is_playing():
-                try:
-                    await bot.change_presence(activity=discord.Activity(
-                        type=discord.ActivityType.listening,
-                        name=current_audio[guild_id]
-                    ))
-                except:
-                    pass
+# ─── PRÉSENCE DU BOT ──────────────────────────────────────────────────────
+_presence = {"name": None, "sent": False}
+
+async def refresh_presence():
+    # Appelé à chaque changement de morceau ; la présence est globale au bot
+    name = next((np.name for np in now_playing.values() if np), None)
+    if _presence["sent"] and name == _presence["name"]:
+        return
+    activity = discord.Activity(type=discord.ActivityType.listening, name=name) if name else None
+    try:
+        await bot.change_presence(activity=activity)
+    except Exception as e:
+        # Non mémorisée : le prochain changement de morceau ou on_ready la renverra
+        print("Erreur présence:", e)
+        _presence["sent"] = False
+        return
+    _presence["name"] = name
+    _presence["sent"] = True
+
+# ─── ARRÊT PROPRE ─────────────────────────────────────────────────────────
+async def graceful_shutdown():
+    # Dernière sauvegarde tant que la boucle tourne encore, puis fermeture du bot
+    async with _queue_write_lock:  # attend l'écriture en cours du queue_flusher
+        await asyncio.to_thread(_write_queues, _snapshot_dirty_queues())
+    pending = _duration_flush["future"]
+    if pending:
+        await asyncio.gather(pending, return_exceptions=True)  # on laisse finir l'écriture périodique en cours
+    if take_duration_flush():
+        await asyncio.to_thread(save_duration_cache)
+    await bot.close()
+
+_shutdown = {"task": None}
+
+def request_shutdown():
+    # Un second Ctrl+C / SIGTERM ne relance pas un arrêt en parallèle du premier
+    if _shutdown["task"] is None:
+        _shutdown["task"] = asyncio.create_task(graceful_shutdown())
+
+@bot.event
+async def setup_hook():
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_shutdown)
+        except NotImplementedError:
+            pass  # Windows : pas de gestionnaire de signaux, bot.run gère déjà Ctrl+C
 
 # ─── DÉMARRAGE DU BOT ─────────────────────────────────────────────────────
 bot.run(TOKEN)
+# Filet de sécurité si la boucle s'est arrêtée sans passer par graceful_shutdown
+flush_queues()
+if take_duration_flush():
+    save_duration_cache()